@@ -1,11 +1,22 @@
+import collections
 import copy
 import datetime
+import gzip
+import hashlib
 import json
+import multiprocessing
+import os
+import queue
 import requests
+import threading
+import time
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from flask import Flask, jsonify, request
 from inspect import stack
 from os.path import exists
+from urllib.parse import urlparse
 
 # ----------------------------------------------------------------------------------------------------
 
@@ -13,35 +24,514 @@ application = Flask(__name__)
 
 catalogueCollectionUrl = 'https://openactive.io/data-catalogs/data-catalog-collection.jsonld'
 
+# Each cache is a directory holding a manifest, which has the metadata, and compressed chunks holding the data at the
+# given depth, i.e. one chunk per catalogue for the dataset URLs and the feeds, and one chunk per feed for the
+# opportunities. The chunks are named by their content, so a refresh only writes those chunks that have changed, and
+# they are only read when they are needed for the output. The single uncompressed files of earlier versions are still
+# read if there is no manifest, and are removed once they have been replaced:
 dirNameCache = './cache/'
+dirNameCatalogueUrls = 'catalogueUrls/'
+dirNameDatasetUrls = 'datasetUrls/'
+dirNameFeeds = 'feeds/'
+dirNameOpportunities = 'opportunities/'
+dirNameOpportunitiesRaw = 'opportunitiesRaw/'
+fileNameManifest = 'manifest.json'
+depthCatalogueUrls = 0
+depthDatasetUrls = 1
+depthFeeds = 1
+depthOpportunities = 3
 fileNameCatalogueUrls = 'catalogueUrls.json'
 fileNameDatasetUrls = 'datasetUrls.json'
 fileNameFeeds = 'feeds.json'
 fileNameOpportunities = 'opportunities.json'
 
+# The fields kept for each opportunity, in addition to 'state', 'id' and 'modified' which are always kept, given as the
+# output field name and the dot-separated path to the field in the source opportunity, with list indices as numbers.
+# Keeping more fields here makes for a larger cache, so fields that are only needed occasionally are better requested
+# via the doFields keyword of get_opportunities, which reads them from the raw opportunities stored via doRaw:
+opportunityFields = {
+    'kind': 'kind',
+    'name': 'data.name',
+    'activityPrefLabel': 'data.activity.0.prefLabel',
+    'activityId': 'data.activity.0.id',
+    'latitude': 'data.location.geo.latitude',
+    'longitude': 'data.location.geo.longitude',
+}
+
+# Requests are spread over a pool of threads, with each host (i.e. publisher) given its own concurrency and spacing
+# between requests. These adapt to the host responses in an AIMD manner (additive increase, multiplicative decrease),
+# so that fast hosts are opened up while slow, failing or blocking hosts are backed off:
+numThreadsMax = 32
+numTriesMax = 10
+hostConcurrencyInitial = 2
+hostConcurrencyMin = 1
+hostConcurrencyMax = 8
+hostDelayMin = 0.1
+hostDelayMax = 30
+hostRateStep = 1
+hostLatencyFactor = 2
+hostErrorRateMax = 0.1
+hostSmoothing = 0.2
+requestsTimeout = 60
+statusCodesBackoff = [403, 429, 500, 502, 503, 504]
+
+hosts = {}
+hostsLock = threading.Lock()
+hostsWaiters = []
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_host(url):
+
+    hostName = urlparse(url).netloc
+
+    with hostsLock:
+        if (hostName not in hosts.keys()):
+            hosts[hostName] = {
+                'numActive': 0,
+                'concurrency': hostConcurrencyInitial,
+                'delay': 0,
+                'timeNextRequest': 0,
+                'latency': None,
+                'latencyMin': None,
+                'errorRate': 0,
+                'numRequests': 0,
+            }
+
+    return hosts[hostName]
+
+# ----------------------------------------------------------------------------------------------------
+
+# This never waits, instead returning the number of seconds until the host may next be tried, or None if that depends
+# on one of its requests in progress finishing first:
+def host_try_acquire(host):
+
+    with hostsLock:
+
+        timeNow = time.monotonic()
+
+        if (host['numActive'] >= int(host['concurrency'])):
+            return None
+        elif (timeNow < host['timeNextRequest']):
+            return host['timeNextRequest'] - timeNow
+
+        host['numActive'] += 1
+        host['timeNextRequest'] = timeNow + host['delay']
+
+        return 0
+
+# ----------------------------------------------------------------------------------------------------
+
+def host_release(host, latency, isError, delayRetryAfter=None):
+
+    with hostsLock:
+
+        host['numActive'] -= 1
+        host['numRequests'] += 1
+
+        if (host['latency'] is None):
+            host['latency'] = latency
+            host['latencyMin'] = latency
+        else:
+            host['latency'] += hostSmoothing * (latency - host['latency'])
+            host['latencyMin'] = min(host['latencyMin'], latency)
+        host['errorRate'] += hostSmoothing * (isError - host['errorRate'])
+
+        # The spacing between requests is treated as a rate, which is halved on an error and otherwise increased by a
+        # fixed step, with no spacing at all once the rate is high enough:
+        if (isError):
+            host['concurrency'] = max(hostConcurrencyMin, host['concurrency'] / 2)
+            host['delay'] = min(hostDelayMax, max(hostDelayMin, host['delay'] * 2))
+        else:
+            if (host['delay'] > 0):
+                host['delay'] = 1 / (1 / host['delay'] + hostRateStep)
+                if (host['delay'] < hostDelayMin):
+                    host['delay'] = 0
+            # A host that has recently been failing, or whose latency is climbing, isn't given any more concurrency
+            # until it recovers:
+            if (    host['errorRate'] <= hostErrorRateMax
+                and host['latency'] <= hostLatencyFactor * host['latencyMin']
+            ):
+                host['concurrency'] = min(hostConcurrencyMax, host['concurrency'] + 1 / host['concurrency'])
+
+        if (delayRetryAfter):
+            host['timeNextRequest'] = max(host['timeNextRequest'], time.monotonic() + min(hostDelayMax, delayRetryAfter))
+
+        # The hosts are shared by all refreshes running at the same time, so any of them that may be waiting on this
+        # slot are woken up to try again:
+        for waiter in hostsWaiters:
+            waiter.put((None, None))
+
+# ----------------------------------------------------------------------------------------------------
+
+def run_request(url):
+
+    timeStart = time.monotonic()
+
+    try:
+        r = requests.get(url, timeout=requestsTimeout)
+    except Exception as exception:
+        return None, exception, time.monotonic() - timeStart
+
+    return r, None, time.monotonic() - timeStart
+
+# ----------------------------------------------------------------------------------------------------
+
+# Pass the response (or the exception in getting it) to the job, and run the job on to its next request or its end:
+def run_job(job, r, exception):
+
+    try:
+        if (exception is not None):
+            return 'request', job.throw(exception)
+        else:
+            return 'request', job.send(r)
+    except StopIteration as stopIteration:
+        return 'done', stopIteration.value
+    except Exception as exception:
+        return 'error', exception
+
+# ----------------------------------------------------------------------------------------------------
+
+# Run the function for each set of arguments, where the function is a generator that yields each URL that it wants to
+# be requested and is sent back the response, or has the exception in getting it raised at the yield, and then returns
+# its result. The requests are queued per host, and are only handed to the threads when the host has a free slot and
+# its spacing between requests has passed, taking the hosts in turn, so that no thread is ever left waiting on a slow
+# or backed-off host while there is work to do for others. A request that fails, or whose response has one of the
+# statusCodesBackoff, is put back at the front of its host queue and tried again once the host is ready, up to
+# numTriesMax times in all, before the last response or exception is passed to the job. The results are returned in the
+# same order as the given arguments:
+def map_requests(function, argsList):
+
+    jobs = [function(*args) for args in argsList]
+    jobsResults = [None] * len(jobs)
+    jobsErrors = [None] * len(jobs)
+    numJobsDone = 0
+
+    hostQueues = {}
+    tasksDone = queue.Queue()
+    numTasksActive = 0
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def handle_job(jobIdx, kind, val):
+        nonlocal numJobsDone
+        if (kind == 'request'):
+            hostQueues.setdefault(urlparse(val).netloc, collections.deque()).append((jobIdx, val, 1))
+        else:
+            if (kind == 'done'):
+                jobsResults[jobIdx] = val
+            else:
+                jobsErrors[jobIdx] = val
+            numJobsDone += 1
+
+    for jobIdx,job in enumerate(jobs):
+        handle_job(jobIdx, *run_job(job, None, None))
+
+    # ----------------------------------------------------------------------------------------------------
+
+    with hostsLock:
+        hostsWaiters.append(tasksDone)
+
+    with ThreadPoolExecutor(max_workers=numThreadsMax) as executor:
+
+        def submit(task, function, *args):
+            nonlocal numTasksActive
+            numTasksActive += 1
+            executor.submit(function, *args).add_done_callback(lambda future: tasksDone.put((task, future.result())))
+
+        while (numJobsDone < len(jobs)):
+
+            # Take one request from each host that is ready in turn, round and round until no more can be sent off:
+            timeWait = None
+            isSubmitted = True
+            while (     isSubmitted
+                    and numTasksActive < numThreadsMax
+            ):
+                isSubmitted = False
+                for hostName,hostQueue in hostQueues.items():
+                    if (    len(hostQueue) == 0
+                        or  numTasksActive == numThreadsMax
+                    ):
+                        continue
+                    jobIdx, url, numTries = hostQueue[0]
+                    host = get_host(url)
+                    timeWaitHost = host_try_acquire(host)
+                    if (timeWaitHost == 0):
+                        hostQueue.popleft()
+                        submit(('request', jobIdx, url, numTries, host), run_request, url)
+                        isSubmitted = True
+                    elif (timeWaitHost is not None):
+                        timeWait = timeWaitHost if (timeWait is None) else min(timeWait, timeWaitHost)
+
+            # ----------------------------------------------------------------------------------------------------
+
+            try:
+                task, taskResult = tasksDone.get(timeout=timeWait)
+            except queue.Empty:
+                continue
+
+            if (task is None):
+                continue
+
+            numTasksActive -= 1
+
+            if (task[0] == 'job'):
+                handle_job(task[1], *taskResult)
+                continue
+
+            _, jobIdx, url, numTries, host = task
+            r, exception, latency = taskResult
+
+            try: delayRetryAfter = float(r.headers['Retry-After'])
+            except: delayRetryAfter = None
+
+            host_release(host, latency, (exception is not None) or (r.status_code in statusCodesBackoff), delayRetryAfter)
+
+            if (    (   exception is not None
+                     or r.status_code in statusCodesBackoff)
+                and numTries < numTriesMax
+            ):
+                hostQueues[urlparse(url).netloc].appendleft((jobIdx, url, numTries + 1))
+            else:
+                submit(('job', jobIdx), run_job, jobs[jobIdx], r, exception)
+
+    with hostsLock:
+        hostsWaiters.remove(tasksDone)
+
+    # ----------------------------------------------------------------------------------------------------
+
+    for jobError in jobsErrors:
+        if (jobError is not None):
+            raise jobError
+
+    return jobsResults
+
+# ----------------------------------------------------------------------------------------------------
+
+def request_job(url):
+
+    return (yield url)
+
 # ----------------------------------------------------------------------------------------------------
 
 def try_requests(url):
 
-    r = requests.get(url)
+    return map_requests(request_job, [(url,)])[0]
+
+# ----------------------------------------------------------------------------------------------------
+
+# The CPU-bound parsing of fetched pages can optionally be sent to a pool of processes, one per core requested via the
+# doProcesses keyword, to get around the GIL. The processes are spawned rather than forked, as the pool is used from
+# within the threads that are fetching the pages. As the keyword can be given in a request to the app, no more
+# processes are started than there are cores:
+def get_process_pool(doProcesses):
+
+    if (    doProcesses
+        and doProcesses > 0
+    ):
+        return ProcessPoolExecutor(max_workers=min(doProcesses, os.cpu_count() or 1), mp_context=multiprocessing.get_context('spawn'))
+    else:
+        return nullcontext()
+
+# ----------------------------------------------------------------------------------------------------
+
+def run_parser(processPool, function, *args):
 
-    numTries = 1
-    numTriesMax = 10
+    if (processPool):
+        return processPool.submit(function, *args).result()
+    else:
+        return function(*args)
 
-    while (r.status_code == 403):
-        r = requests.get(url)
-        numTries += 1
-        if (numTries == numTriesMax):
-            break;
+# ----------------------------------------------------------------------------------------------------
 
-    return r
+def read_cache(dirName, fileNameLegacy):
+
+    if (exists(dirNameCache + dirName + fileNameManifest)):
+        return json.load(open(dirNameCache + dirName + fileNameManifest, 'r'))
+    elif (exists(dirNameCache + fileNameLegacy)):
+        return json.load(open(dirNameCache + fileNameLegacy, 'r'))
+    else:
+        return None
 
 # ----------------------------------------------------------------------------------------------------
 
-if (exists(dirNameCache + fileNameCatalogueUrls)):
-    catalogueUrls = json.load(open(dirNameCache + fileNameCatalogueUrls, 'r'))
-else:
-    catalogueUrls = None
+def write_file_compressed(fileName, content):
+
+    with gzip.open(fileName + '.tmp', 'wb') as file:
+        file.write(content)
+
+    os.replace(fileName + '.tmp', fileName)
+
+# ----------------------------------------------------------------------------------------------------
+
+# Only the data lists at the leaves of the tree go into a chunk, with the metadata of any nodes in between kept in the
+# manifest, so that the timestamps updated on every refresh don't change the chunk unless its data has changed too:
+def get_chunk_content(tree):
+
+    if (type(tree['data']) == list):
+        return tree['data']
+
+    return {
+        key: get_chunk_content(val)
+        for key,val in tree['data'].items()
+    }
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_chunk_skeleton(tree):
+
+    if (type(tree['data']) == list):
+        return {
+            'metadata': tree['metadata'],
+            'data': [],
+        }
+
+    return {
+        'metadata': tree['metadata'],
+        'data': {
+            key: get_chunk_skeleton(val)
+            for key,val in tree['data'].items()
+        },
+    }
+
+# ----------------------------------------------------------------------------------------------------
+
+def set_chunk_content(tree, content):
+
+    if (type(tree['data']) == list):
+        tree['data'] = content
+    else:
+        for key,val in tree['data'].items():
+            set_chunk_content(val, content[key])
+
+# ----------------------------------------------------------------------------------------------------
+
+# The chunks are taken at the given depth of the tree, e.g. a depth of 1 gives one chunk per catalogue. In the manifest,
+# and in memory until it is read, a chunk has empty leaf data alongside the name of its file, which is kept out of the
+# metadata so that it never appears in the output:
+def write_cache_chunks(tree, dirName, depth, chunks):
+
+    if (depth > 0):
+        return {
+            'metadata': tree['metadata'],
+            'data': {
+                key: write_cache_chunks(val, dirName, depth - 1, chunks)
+                for key,val in tree['data'].items()
+            },
+        }
+
+    chunk = tree.get('chunk')
+
+    if (chunk is None):
+        content = json.dumps(get_chunk_content(tree)).encode()
+        chunk = hashlib.sha1(content).hexdigest()
+        if (not exists(dirNameCache + dirName + chunk + '.json.gz')):
+            write_file_compressed(dirNameCache + dirName + chunk + '.json.gz', content)
+
+    chunks.add(chunk + '.json.gz')
+
+    manifest = get_chunk_skeleton(tree)
+    manifest['chunk'] = chunk
+
+    return manifest
+
+# ----------------------------------------------------------------------------------------------------
+
+def write_cache(tree, dirName, depth, fileNameLegacy):
+
+    os.makedirs(dirNameCache + dirName, exist_ok=True)
+
+    chunks = set()
+    manifest = write_cache_chunks(tree, dirName, depth, chunks)
+
+    json.dump(manifest, open(dirNameCache + dirName + fileNameManifest + '.tmp', 'w'))
+    os.replace(dirNameCache + dirName + fileNameManifest + '.tmp', dirNameCache + dirName + fileNameManifest)
+
+    # Only now that the new manifest is in place can the chunks that it no longer refers to, and any cache file of the
+    # older form, be removed:
+    for fileName in os.listdir(dirNameCache + dirName):
+        if (    fileName.endswith('.json.gz')
+            and fileName not in chunks
+        ):
+            os.remove(dirNameCache + dirName + fileName)
+
+    if (exists(dirNameCache + fileNameLegacy)):
+        os.remove(dirNameCache + fileNameLegacy)
+
+# ----------------------------------------------------------------------------------------------------
+
+# Read in any chunks not yet read, and keep them in memory for next time. The keys can be used to limit the reading to
+# certain branches of the tree, one key per level, with None meaning all branches at that level. The returned tree is a
+# view of the given tree, which for any such limits has only the selected branches, and counts to match:
+# Another process sharing the cache, such as another worker serving the app, may have refreshed it since the manifest
+# was read, and so removed chunks that the tree in memory still refers to. If so then the manifest is read again in
+# place of the tree, and the view taken again from that:
+def read_cache_chunks(tree, dirName, depth, keys=[]):
+
+    try:
+        return read_cache_view(tree, dirName, depth, keys, True)
+    except FileNotFoundError:
+        if (exists(dirNameCache + dirName + fileNameManifest)):
+            manifest = json.load(open(dirNameCache + dirName + fileNameManifest, 'r'))
+            tree.clear()
+            tree.update(manifest)
+
+    return read_cache_view(tree, dirName, depth, keys, False)
+
+# ----------------------------------------------------------------------------------------------------
+
+def read_cache_view(tree, dirName, depth, keys, doRaiseMissing):
+
+    chunk = tree.get('chunk')
+
+    if (chunk is not None):
+        try:
+            with gzip.open(dirNameCache + dirName + chunk + '.json.gz', 'rt') as file:
+                set_chunk_content(tree, json.load(file))
+            tree.pop('chunk', None)
+        except FileNotFoundError:
+            if (doRaiseMissing):
+                raise
+            print('ERROR: Can\'t read cache chunk', dirName + chunk)
+        except:
+            print('ERROR: Can\'t read cache chunk', dirName + chunk)
+
+    if (depth == 0):
+        return {
+            'metadata': tree['metadata'],
+            'data': tree['data'],
+        }
+
+    # ----------------------------------------------------------------------------------------------------
+
+    output = {
+        'metadata': tree['metadata'],
+        'data': {},
+    }
+
+    for key,val in tree['data'].items():
+        if (    len(keys) == 0
+            or  keys[0] is None
+            or  key == keys[0]
+        ):
+            outputVal = read_cache_view(val, dirName, depth - 1, keys[1:], doRaiseMissing)
+            if (    not any([key is not None for key in keys[1:]])
+                or  len(outputVal['data']) > 0
+            ):
+                output['data'][key] = outputVal
+
+    if (any([key is not None for key in keys])):
+        output['metadata'] = dict(tree['metadata'])
+        output['metadata']['counts'] = sum([
+            val['metadata']['counts']
+            for val in output['data'].values()
+        ])
+
+    return output
+
+# ----------------------------------------------------------------------------------------------------
+
+catalogueUrls = read_cache(dirNameCatalogueUrls, fileNameCatalogueUrls)
 
 @application.route('/catalogueurls')
 def get_catalogue_urls(
@@ -99,24 +589,64 @@ def get_catalogue_urls(
 
     # ----------------------------------------------------------------------------------------------------
 
-    if (    not exists(dirNameCache + fileNameCatalogueUrls)
+    if (    not exists(dirNameCache + dirNameCatalogueUrls + fileNameManifest)
         or  doRefresh
     ):
-        json.dump(catalogueUrls, open(dirNameCache + fileNameCatalogueUrls, 'w'))
+        write_cache(catalogueUrls, dirNameCatalogueUrls, depthCatalogueUrls, fileNameCatalogueUrls)
 
     # ----------------------------------------------------------------------------------------------------
 
+    output = read_cache_chunks(catalogueUrls, dirNameCatalogueUrls, depthCatalogueUrls)
+
     if (doMetadata):
-        return catalogueUrls
+        return output
     else:
-        return catalogueUrls['data']
+        return output['data']
 
 # ----------------------------------------------------------------------------------------------------
 
-if (exists(dirNameCache + fileNameDatasetUrls)):
-    datasetUrls = json.load(open(dirNameCache + fileNameDatasetUrls, 'r'))
-else:
-    datasetUrls = None
+def get_catalogue_dataset_urls(catalogueUrl, doLimitDatasets):
+
+    catalogueDatasetUrls = {
+        'metadata': {
+            'counts': 0,
+            'timeLastUpdated': None,
+        },
+        'data': [],
+    }
+
+    # ----------------------------------------------------------------------------------------------------
+
+    try:
+        r2 = yield catalogueUrl
+    except:
+        print('ERROR: Can\'t get catalogue', catalogueUrl)
+        return None
+
+    # ----------------------------------------------------------------------------------------------------
+
+    if (    r2.status_code == 200
+        and r2.json()
+        and type(r2.json()) == dict
+        and 'dataset' in r2.json().keys()
+        and type(r2.json()['dataset']) == list
+    ):
+        for datasetUrl in r2.json()['dataset'][0:doLimitDatasets]:
+            if (    type(datasetUrl) == str
+                and datasetUrl not in catalogueDatasetUrls['data']
+            ):
+                catalogueDatasetUrls['data'].append(datasetUrl)
+
+    # ----------------------------------------------------------------------------------------------------
+
+    catalogueDatasetUrls['metadata']['counts'] = len(catalogueDatasetUrls['data'])
+    catalogueDatasetUrls['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
+
+    return catalogueDatasetUrls
+
+# ----------------------------------------------------------------------------------------------------
+
+datasetUrls = read_cache(dirNameDatasetUrls, fileNameDatasetUrls)
 
 @application.route('/dataseturls')
 def get_dataset_urls(
@@ -159,44 +689,15 @@ def get_dataset_urls(
 
         # ----------------------------------------------------------------------------------------------------
 
-        for catalogueUrl in catalogueUrls['data']:
-
-            catalogueDatasetUrls = {
-                'metadata': {
-                    'counts': 0,
-                    'timeLastUpdated': None,
-                },
-                'data': [],
-            }
-
-            # ----------------------------------------------------------------------------------------------------
-
-            try:
-                r2 = try_requests(catalogueUrl)
-            except:
-                print('ERROR: Can\'t get catalogue', catalogueUrl)
-                continue
-
-            # ----------------------------------------------------------------------------------------------------
-
-            if (    r2.status_code == 200
-                and r2.json()
-                and type(r2.json()) == dict
-                and 'dataset' in r2.json().keys()
-                and type(r2.json()['dataset']) == list
-            ):
-                for datasetUrl in r2.json()['dataset'][0:doLimitDatasets]:
-                    if (    type(datasetUrl) == str
-                        and datasetUrl not in catalogueDatasetUrls['data']
-                    ):
-                        catalogueDatasetUrls['data'].append(datasetUrl)
-
-            # ----------------------------------------------------------------------------------------------------
-
-            catalogueDatasetUrls['metadata']['counts'] = len(catalogueDatasetUrls['data'])
-            catalogueDatasetUrls['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
-
-            datasetUrls['data'][catalogueUrl] = catalogueDatasetUrls
+        for catalogueUrl,catalogueDatasetUrls in zip(
+            catalogueUrls['data'],
+            map_requests(
+                get_catalogue_dataset_urls,
+                [(catalogueUrl, doLimitDatasets) for catalogueUrl in catalogueUrls['data']],
+            ),
+        ):
+            if (catalogueDatasetUrls is not None):
+                datasetUrls['data'][catalogueUrl] = catalogueDatasetUrls
 
         # ----------------------------------------------------------------------------------------------------
 
@@ -208,33 +709,122 @@ def get_dataset_urls(
 
     # ----------------------------------------------------------------------------------------------------
 
-    if (    not exists(dirNameCache + fileNameDatasetUrls)
+    if (    not exists(dirNameCache + dirNameDatasetUrls + fileNameManifest)
         or  doRefresh
     ):
-        json.dump(datasetUrls, open(dirNameCache + fileNameDatasetUrls, 'w'))
+        write_cache(datasetUrls, dirNameDatasetUrls, depthDatasetUrls, fileNameDatasetUrls)
 
     # ----------------------------------------------------------------------------------------------------
 
+    output = read_cache_chunks(datasetUrls, dirNameDatasetUrls, depthDatasetUrls)
+
     if (doFlatten):
         return [
             val2
-            for val1 in datasetUrls['data'].values()
+            for val1 in output['data'].values()
             for val2 in val1['data']
         ]
     elif (doMetadata):
-        return datasetUrls
+        return output
     else:
         return {
             key: val['data']
-            for key,val in datasetUrls['data'].items()
+            for key,val in output['data'].items()
         }
 
 # ----------------------------------------------------------------------------------------------------
 
-if (exists(dirNameCache + fileNameFeeds)):
-    feeds = json.load(open(dirNameCache + fileNameFeeds, 'r'))
-else:
-    feeds = None
+# This only does the parsing and extraction of an already fetched dataset page, and so can be run in a separate process
+# to the fetching:
+def parse_dataset_page(text, doLimitFeeds):
+
+    soup = BeautifulSoup(text, 'html.parser')
+
+    if (not soup.head):
+        return None
+
+    datasetFeedsData = []
+
+    for val in soup.head.find_all('script'):
+        if (    'type' in val.attrs.keys()
+            and val['type'] == 'application/ld+json'
+        ):
+
+            jsonld = json.loads(val.string)
+
+            if (    type(jsonld) == dict
+                and 'distribution' in jsonld.keys()
+                and type(jsonld['distribution']) == list
+            ):
+                for feedInfo in jsonld['distribution'][0:doLimitFeeds]:
+                    if (type(feedInfo) == dict):
+
+                        datasetFeed = {}
+
+                        try: datasetFeed['url'] = feedInfo['contentUrl']
+                        except: pass
+                        # This is intentionally labelled as 'kind' to match opportunity info, and to avoid 'type' which is
+                        # preferable but used in other contexts:
+                        try: datasetFeed['kind'] = feedInfo['name']
+                        except: pass
+                        try: datasetFeed['datasetName'] = jsonld['name']
+                        except: pass
+                        try: datasetFeed['datasetPublisherName'] = jsonld['publisher']['name']
+                        except: pass
+                        try: datasetFeed['discussionUrl'] = jsonld['discussionUrl']
+                        except: pass
+                        try: datasetFeed['licenseUrl'] = jsonld['license']
+                        except: pass
+
+                        if (len(datasetFeed.keys()) > 0):
+                            datasetFeedsData.append(datasetFeed)
+
+    return datasetFeedsData
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_dataset_feeds(datasetUrl, catalogueUrl, doLimitFeeds, processPool):
+
+    datasetFeeds = {
+        'metadata': {
+            'counts': 0,
+            'timeLastUpdated': None,
+        },
+        'data': [],
+    }
+
+    # ----------------------------------------------------------------------------------------------------
+
+    try:
+        r3 = yield datasetUrl
+    except:
+        print('ERROR: Can\'t get dataset', catalogueUrl, '->', datasetUrl)
+        return None
+
+    # ----------------------------------------------------------------------------------------------------
+
+    if (    r3.status_code == 200
+        and r3.text
+        and type(r3.text) == str
+    ):
+
+        datasetFeedsData = run_parser(processPool, parse_dataset_page, r3.text, doLimitFeeds)
+
+        if (datasetFeedsData is None):
+            return None
+
+        datasetFeeds['data'] = datasetFeedsData
+
+    # ----------------------------------------------------------------------------------------------------
+
+    datasetFeeds['metadata']['counts'] = len(datasetFeeds['data'])
+    datasetFeeds['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
+
+    return datasetFeeds
+
+# ----------------------------------------------------------------------------------------------------
+
+feeds = read_cache(dirNameFeeds, fileNameFeeds)
 
 @application.route('/feeds')
 def get_feeds(
@@ -245,6 +835,7 @@ def get_feeds(
     doLimitDatasets = None,
     doLimitFeeds = None,
     doPath = False,
+    doProcesses = None,
 ):
 
     if (stack()[1].function == 'dispatch_request'):
@@ -255,6 +846,7 @@ def get_feeds(
         doLimitDatasets = request.args.get('doLimitDatasets', default=None, type=int)
         doLimitFeeds = request.args.get('doLimitFeeds', default=None, type=int)
         doPath = request.args.get('doPath', default=False, type=lambda arg: arg.lower()=='true')
+        doProcesses = request.args.get('doProcesses', default=None, type=int)
 
     # ----------------------------------------------------------------------------------------------------
 
@@ -283,7 +875,6 @@ def get_feeds(
         # ----------------------------------------------------------------------------------------------------
 
         for catalogueUrl in datasetUrls['data'].keys():
-
             feeds['data'][catalogueUrl] = {
                 'metadata': {
                     'counts': 0,
@@ -292,81 +883,24 @@ def get_feeds(
                 'data': {},
             }
 
-            # ----------------------------------------------------------------------------------------------------
-
-            for datasetUrl in datasetUrls['data'][catalogueUrl]['data']:
-
-                datasetFeeds = {
-                    'metadata': {
-                        'counts': 0,
-                        'timeLastUpdated': None,
-                    },
-                    'data': [],
-                }
-
-                # ----------------------------------------------------------------------------------------------------
-
-                try:
-                    r3 = try_requests(datasetUrl)
-                except:
-                    print('ERROR: Can\'t get dataset', catalogueUrl, '->', datasetUrl)
-                    continue
-
-                # ----------------------------------------------------------------------------------------------------
-
-                if (    r3.status_code == 200
-                    and r3.text
-                    and type(r3.text) == str
-                ):
-
-                    soup = BeautifulSoup(r3.text, 'html.parser')
-
-                    if (not soup.head):
-                        continue
-
-                    for val in soup.head.find_all('script'):
-                        if (    'type' in val.attrs.keys()
-                            and val['type'] == 'application/ld+json'
-                        ):
-
-                            jsonld = json.loads(val.string)
-
-                            if (    type(jsonld) == dict
-                                and 'distribution' in jsonld.keys()
-                                and type(jsonld['distribution']) == list
-                            ):
-                                for feedInfo in jsonld['distribution'][0:doLimitFeeds]:
-                                    if (type(feedInfo) == dict):
-
-                                        datasetFeed = {}
-
-                                        try: datasetFeed['url'] = feedInfo['contentUrl']
-                                        except: pass
-                                        # This is intentionally labelled as 'kind' to match opportunity info, and to avoid 'type' which is
-                                        # preferable but used in other contexts:
-                                        try: datasetFeed['kind'] = feedInfo['name']
-                                        except: pass
-                                        try: datasetFeed['datasetName'] = jsonld['name']
-                                        except: pass
-                                        try: datasetFeed['datasetPublisherName'] = jsonld['publisher']['name']
-                                        except: pass
-                                        try: datasetFeed['discussionUrl'] = jsonld['discussionUrl']
-                                        except: pass
-                                        try: datasetFeed['licenseUrl'] = jsonld['license']
-                                        except: pass
-
-                                        if (len(datasetFeed.keys()) > 0):
-                                            datasetFeeds['data'].append(datasetFeed)
+        # ----------------------------------------------------------------------------------------------------
 
-                # ----------------------------------------------------------------------------------------------------
+        with get_process_pool(doProcesses) as processPool:
 
-                datasetFeeds['metadata']['counts'] = len(datasetFeeds['data'])
-                datasetFeeds['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
+            argsList = [
+                (datasetUrl, catalogueUrl, doLimitFeeds, processPool)
+                for catalogueUrl in datasetUrls['data'].keys()
+                for datasetUrl in datasetUrls['data'][catalogueUrl]['data']
+            ]
 
-                feeds['data'][catalogueUrl]['data'][datasetUrl] = datasetFeeds
+            for args,datasetFeeds in zip(argsList, map_requests(get_dataset_feeds, argsList)):
+                if (datasetFeeds is not None):
+                    datasetUrl, catalogueUrl = args[0:2]
+                    feeds['data'][catalogueUrl]['data'][datasetUrl] = datasetFeeds
 
-            # ----------------------------------------------------------------------------------------------------
+        # ----------------------------------------------------------------------------------------------------
 
+        for catalogueUrl in feeds['data'].keys():
             feeds['data'][catalogueUrl]['metadata']['counts'] = sum([
                 val['metadata']['counts']
                 for val in feeds['data'][catalogueUrl]['data'].values()
@@ -383,17 +917,17 @@ def get_feeds(
 
     # ----------------------------------------------------------------------------------------------------
 
-    if (    not exists(dirNameCache + fileNameFeeds)
+    if (    not exists(dirNameCache + dirNameFeeds + fileNameManifest)
         or  doRefresh
     ):
-        json.dump(feeds, open(dirNameCache + fileNameFeeds, 'w'))
+        write_cache(feeds, dirNameFeeds, depthFeeds, fileNameFeeds)
 
     # ----------------------------------------------------------------------------------------------------
 
-    if (not doPath):
-        output = feeds
-    else:
-        output = copy.deepcopy(feeds)
+    output = read_cache_chunks(feeds, dirNameFeeds, depthFeeds)
+
+    if (doPath):
+        output = copy.deepcopy(output)
         for catalogueUrl in output['data'].keys():
             for datasetUrl in output['data'][catalogueUrl]['data'].keys():
                 for feed in output['data'][catalogueUrl]['data'][datasetUrl]['data']:
@@ -432,6 +966,7 @@ def get_feed_urls(
     doLimitCatalogues = None,
     doLimitDatasets = None,
     doLimitFeeds = None,
+    doProcesses = None,
 ):
 
     if (stack()[1].function == 'dispatch_request'):
@@ -441,6 +976,7 @@ def get_feed_urls(
         doLimitCatalogues = request.args.get('doLimitCatalogues', default=None, type=int)
         doLimitDatasets = request.args.get('doLimitDatasets', default=None, type=int)
         doLimitFeeds = request.args.get('doLimitFeeds', default=None, type=int)
+        doProcesses = request.args.get('doProcesses', default=None, type=int)
 
     # ----------------------------------------------------------------------------------------------------
 
@@ -455,11 +991,12 @@ def get_feed_urls(
             doLimitCatalogues = doLimitCatalogues,
             doLimitDatasets = doLimitDatasets,
             doLimitFeeds = doLimitFeeds,
+            doProcesses = doProcesses,
         )
 
         # ----------------------------------------------------------------------------------------------------
 
-        feedUrls = copy.deepcopy(feeds)
+        feedUrls = copy.deepcopy(read_cache_chunks(feeds, dirNameFeeds, depthFeeds))
 
         # ----------------------------------------------------------------------------------------------------
 
@@ -492,10 +1029,193 @@ def get_feed_urls(
 
 # ----------------------------------------------------------------------------------------------------
 
-if (exists(dirNameCache + fileNameOpportunities)):
-    opportunities = json.load(open(dirNameCache + fileNameOpportunities, 'r'))
-else:
-    opportunities = None
+# The fields can be given as a dictionary of output field names and paths, or as a list of paths to be used as the
+# output field names themselves. Each path is split up beforehand so that this isn't repeated for every opportunity:
+def compile_fields(fields):
+
+    if (type(fields) != dict):
+        fields = {
+            path: path
+            for path in fields
+        }
+
+    return [
+        (
+            name,
+            tuple([
+                int(key) if key.isdigit() else key
+                for key in path.split('.')
+            ]),
+        )
+        for name,path in fields.items()
+    ]
+
+# ----------------------------------------------------------------------------------------------------
+
+def project_fields(opportunityInfo, fieldsCompiled, feedOpportunity):
+
+    for name,keys in fieldsCompiled:
+        val = opportunityInfo
+        try:
+            for key in keys:
+                val = val[key]
+        except:
+            continue
+        feedOpportunity[name] = val
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_file_name_opportunities_raw(feedUrl):
+
+    return dirNameCache + dirNameOpportunitiesRaw + hashlib.sha1(feedUrl.encode()).hexdigest() + '.json.gz'
+
+# ----------------------------------------------------------------------------------------------------
+
+# This only does the decoding and extraction of an already fetched feed page, and so can be run in a separate process
+# to the fetching. The page of opportunities is returned as one batch, with deleted opportunities reduced to just the
+# fields needed to remove them, along with the full source opportunities if these are to be stored too, and the URL
+# of the next page:
+def parse_feed_page(content, fieldsCompiled, doRaw=False):
+
+    page = json.loads(content)
+
+    if (    not page
+        or  type(page) != dict
+    ):
+        return None
+
+    # ----------------------------------------------------------------------------------------------------
+
+    feedOpportunitiesBatch = []
+    opportunitiesRawBatch = [] if doRaw else None
+
+    if (    'items' in page.keys()
+        and type(page['items']) == list
+    ):
+        for opportunityInfo in page['items']:
+            if (    type(opportunityInfo) == dict
+                and 'state' in opportunityInfo.keys()
+                and 'id' in opportunityInfo.keys()
+                and 'modified' in opportunityInfo.keys()
+            ):
+
+                feedOpportunity = {}
+
+                # Most states should be 'updated', so only output the outliers to check what they are:
+                if (opportunityInfo['state'] != 'updated'):
+                    feedOpportunity['state'] = opportunityInfo['state']
+                feedOpportunity['id'] = opportunityInfo['id']
+                feedOpportunity['modified'] = opportunityInfo['modified']
+
+                if (opportunityInfo['state'] != 'deleted'):
+                    project_fields(opportunityInfo, fieldsCompiled, feedOpportunity)
+
+                feedOpportunitiesBatch.append(feedOpportunity)
+
+                if (doRaw):
+                    opportunitiesRawBatch.append(opportunityInfo if (opportunityInfo['state'] != 'deleted') else None)
+
+    # ----------------------------------------------------------------------------------------------------
+
+    if (    'next' in page.keys()
+        and type(page['next']) == str
+    ):
+        feedUrlNext = page['next']
+    else:
+        feedUrlNext = None
+
+    return feedOpportunitiesBatch, opportunitiesRawBatch, feedUrlNext
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_feed_opportunities(feedUrl, catalogueUrl, datasetUrl, doLimitOpportunities, fieldsCompiled, doRaw, processPool):
+
+    feedOpportunities = {
+        'metadata': {
+            'counts': 0,
+            'timeLastUpdated': None,
+        },
+        'data': {},
+    }
+
+    feedOpportunitiesRaw = {}
+
+    # ----------------------------------------------------------------------------------------------------
+
+    feedUrlCurrent = feedUrl
+
+    while (feedUrlCurrent):
+
+        try:
+            r4 = yield feedUrlCurrent
+        except:
+            print('ERROR: Can\'t get feed', catalogueUrl, '->', datasetUrl, '->', feedUrlCurrent)
+            break
+
+        # ----------------------------------------------------------------------------------------------------
+
+        if (r4.status_code == 200):
+            feedPage = run_parser(processPool, parse_feed_page, r4.content, fieldsCompiled, doRaw)
+        else:
+            feedPage = None
+
+        if (feedPage is not None):
+
+            feedOpportunitiesBatch, opportunitiesRawBatch, feedUrlNext = feedPage
+
+            for feedOpportunityIdx,feedOpportunity in enumerate(feedOpportunitiesBatch):
+                if (    feedOpportunity['id'] not in feedOpportunities['data'].keys()
+                    or  feedOpportunity['modified'] > feedOpportunities['data'][feedOpportunity['id']]['modified']
+                ):
+
+                    if (    'state' in feedOpportunity.keys()
+                        and feedOpportunity['state'] == 'deleted'
+                    ):
+                        if (feedOpportunity['id'] in feedOpportunities['data'].keys()):
+                            del(feedOpportunities['data'][feedOpportunity['id']])
+                            if (doRaw):
+                                del(feedOpportunitiesRaw[str(feedOpportunity['id'])])
+                        continue
+
+                    feedOpportunities['data'][feedOpportunity['id']] = feedOpportunity
+                    if (doRaw):
+                        feedOpportunitiesRaw[str(feedOpportunity['id'])] = opportunitiesRawBatch[feedOpportunityIdx]
+
+                    if (len(feedOpportunities['data']) == doLimitOpportunities):
+                        break
+
+            if (    feedUrlNext
+                and feedUrlNext != feedUrlCurrent
+                and len(feedOpportunities['data']) != doLimitOpportunities
+            ):
+                feedUrlCurrent = feedUrlNext
+            else:
+                feedUrlCurrent = None
+
+        else:
+            print('ERROR: Problem with feed', catalogueUrl, '->', datasetUrl, '->', feedUrlCurrent)
+            feedUrlCurrent = None
+
+    # ----------------------------------------------------------------------------------------------------
+
+    feedOpportunities['data'] = list(feedOpportunities['data'].values())
+    # feedOpportunities['data'] = list(feedOpportunities['data'].keys())
+
+    # The source opportunities are kept out of the main cache, in a compressed file per feed keyed by opportunity ID
+    # (as a string, as for any JSON key) that is only read when fields beyond those in the main cache are requested:
+    if (doRaw):
+        write_file_compressed(get_file_name_opportunities_raw(feedUrl), json.dumps(feedOpportunitiesRaw).encode())
+
+    # ----------------------------------------------------------------------------------------------------
+
+    feedOpportunities['metadata']['counts'] = len(feedOpportunities['data'])
+    feedOpportunities['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
+
+    return feedOpportunities
+
+# ----------------------------------------------------------------------------------------------------
+
+opportunities = read_cache(dirNameOpportunities, fileNameOpportunities)
 
 @application.route('/opportunities')
 def get_opportunities(
@@ -507,6 +1227,12 @@ def get_opportunities(
     doLimitFeeds = None,
     doLimitOpportunities = None,
     doPath = False,
+    doProcesses = None,
+    doRaw = False,
+    doFields = None,
+    doCatalogueUrl = None,
+    doDatasetUrl = None,
+    doFeedUrl = None,
 ):
 
     if (stack()[1].function == 'dispatch_request'):
@@ -518,6 +1244,12 @@ def get_opportunities(
         doLimitFeeds = request.args.get('doLimitFeeds', default=None, type=int)
         doLimitOpportunities = request.args.get('doLimitOpportunities', default=None, type=int)
         doPath = request.args.get('doPath', default=False, type=lambda arg: arg.lower()=='true')
+        doProcesses = request.args.get('doProcesses', default=None, type=int)
+        doRaw = request.args.get('doRaw', default=False, type=lambda arg: arg.lower()=='true')
+        doFields = request.args.get('doFields', default=None, type=lambda arg: arg.split(','))
+        doCatalogueUrl = request.args.get('doCatalogueUrl', default=None, type=str)
+        doDatasetUrl = request.args.get('doDatasetUrl', default=None, type=str)
+        doFeedUrl = request.args.get('doFeedUrl', default=None, type=str)
 
     # ----------------------------------------------------------------------------------------------------
 
@@ -532,6 +1264,7 @@ def get_opportunities(
             doLimitCatalogues = doLimitCatalogues,
             doLimitDatasets = doLimitDatasets,
             doLimitFeeds = doLimitFeeds,
+            doProcesses = doProcesses,
         )
 
         # ----------------------------------------------------------------------------------------------------
@@ -547,7 +1280,6 @@ def get_opportunities(
         # ----------------------------------------------------------------------------------------------------
 
         for catalogueUrl in feedUrls['data'].keys():
-
             opportunities['data'][catalogueUrl] = {
                 'metadata': {
                     'counts': 0,
@@ -555,11 +1287,7 @@ def get_opportunities(
                 },
                 'data': {},
             }
-
-            # ----------------------------------------------------------------------------------------------------
-
             for datasetUrl in feedUrls['data'][catalogueUrl]['data'].keys():
-
                 opportunities['data'][catalogueUrl]['data'][datasetUrl] = {
                     'metadata': {
                         'counts': 0,
@@ -568,118 +1296,47 @@ def get_opportunities(
                     'data': {},
                 }
 
-                # ----------------------------------------------------------------------------------------------------
+        # ----------------------------------------------------------------------------------------------------
 
-                for feedUrl in feedUrls['data'][catalogueUrl]['data'][datasetUrl]['data']:
+        if (doRaw):
+            os.makedirs(dirNameCache + dirNameOpportunitiesRaw, exist_ok=True)
 
-                    feedOpportunities = {
-                        'metadata': {
-                            'counts': 0,
-                            'timeLastUpdated': None,
-                        },
-                        'data': {},
-                    }
+        fieldsCompiled = compile_fields(opportunityFields)
 
-                    # ----------------------------------------------------------------------------------------------------
+        with get_process_pool(doProcesses) as processPool:
 
-                    feedUrlCurrent = feedUrl
+            argsList = [
+                (feedUrl, catalogueUrl, datasetUrl, doLimitOpportunities, fieldsCompiled, doRaw, processPool)
+                for catalogueUrl in feedUrls['data'].keys()
+                for datasetUrl in feedUrls['data'][catalogueUrl]['data'].keys()
+                for feedUrl in feedUrls['data'][catalogueUrl]['data'][datasetUrl]['data']
+            ]
 
-                    while (feedUrlCurrent):
+            for args,feedOpportunities in zip(argsList, map_requests(get_feed_opportunities, argsList)):
+                feedUrl, catalogueUrl, datasetUrl = args[0:3]
+                opportunities['data'][catalogueUrl]['data'][datasetUrl]['data'][feedUrl] = feedOpportunities
 
-                        try:
-                            r4 = try_requests(feedUrlCurrent)
-                        except:
-                            print('ERROR: Can\'t get feed', catalogueUrl, '->', datasetUrl, '->', feedUrlCurrent)
-                            continue
+        # Remove the files of source opportunities for any feeds that are no longer present:
+        if (doRaw):
+            fileNamesRaw = set([
+                get_file_name_opportunities_raw(args[0])
+                for args in argsList
+            ])
+            for fileName in os.listdir(dirNameCache + dirNameOpportunitiesRaw):
+                if (dirNameCache + dirNameOpportunitiesRaw + fileName not in fileNamesRaw):
+                    os.remove(dirNameCache + dirNameOpportunitiesRaw + fileName)
 
-                        # ----------------------------------------------------------------------------------------------------
+        # ----------------------------------------------------------------------------------------------------
 
-                        if (    r4.status_code == 200
-                            and r4.json()
-                            and type(r4.json()) == dict
-                        ):
-                            if (    'items' in r4.json().keys()
-                                and type(r4.json()['items']) == list
-                            ):
-                                for opportunityInfo in r4.json()['items']:
-                                    if (    type(opportunityInfo) == dict
-                                        and 'state' in opportunityInfo.keys()
-                                        and 'id' in opportunityInfo.keys()
-                                        and 'modified' in opportunityInfo.keys()
-                                        and (   opportunityInfo['id'] not in feedOpportunities['data'].keys()
-                                            or  opportunityInfo['modified'] > feedOpportunities['data'][opportunityInfo['id']]['modified'] )
-                                    ):
-
-                                        if (opportunityInfo['state'] == 'deleted'):
-                                            if (opportunityInfo['id'] in feedOpportunities['data'].keys()):
-                                                del(feedOpportunities['data'][opportunityInfo['id']])
-                                            continue
-
-                                        feedOpportunity = {}
-
-                                        # Most states should be 'updated', so only output the outliers to check what they are:
-                                        if (opportunityInfo['state'] != 'updated'):
-                                            feedOpportunity['state'] = opportunityInfo['state']
-                                        feedOpportunity['id'] = opportunityInfo['id']
-                                        feedOpportunity['modified'] = opportunityInfo['modified']
-                                        try: feedOpportunity['kind'] = opportunityInfo['kind']
-                                        except: pass
-                                        try: feedOpportunity['name'] = opportunityInfo['data']['name']
-                                        except: pass
-                                        try: feedOpportunity['activityPrefLabel'] = opportunityInfo['data']['activity'][0]['prefLabel']
-                                        except: pass
-                                        try: feedOpportunity['activityId'] = opportunityInfo['data']['activity'][0]['id']
-                                        except: pass
-                                        try: feedOpportunity['latitude'] = opportunityInfo['data']['location']['geo']['latitude']
-                                        except: pass
-                                        try: feedOpportunity['longitude'] = opportunityInfo['data']['location']['geo']['longitude']
-                                        except: pass
-
-                                        # These were just to check the available keys, but take up a lot of cache file space:
-                                        # feedOpportunity['keys'] = list(opportunityInfo.keys())
-                                        # try: feedOpportunity['keysData'] = list(opportunityInfo['data'].keys())
-                                        # except: pass
-
-                                        feedOpportunities['data'][opportunityInfo['id']] = feedOpportunity
-
-                                        if (len(feedOpportunities['data']) == doLimitOpportunities):
-                                            break
-
-                            if (    'next' in r4.json().keys()
-                                and type(r4.json()['next']) == str
-                                and r4.json()['next'] != feedUrlCurrent
-                                and len(feedOpportunities['data']) != doLimitOpportunities
-                            ):
-                                feedUrlCurrent = r4.json()['next']
-                            else:
-                                feedUrlCurrent = None
-
-                        else:
-                            print('ERROR: Problem with feed', catalogueUrl, '->', datasetUrl, '->', feedUrlCurrent)
-                            feedUrlCurrent = None
-
-                    # ----------------------------------------------------------------------------------------------------
-
-                    feedOpportunities['data'] = list(feedOpportunities['data'].values())
-                    # feedOpportunities['data'] = list(feedOpportunities['data'].keys())
-
-                    # ----------------------------------------------------------------------------------------------------
-
-                    feedOpportunities['metadata']['counts'] = len(feedOpportunities['data'])
-                    feedOpportunities['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
-
-                    opportunities['data'][catalogueUrl]['data'][datasetUrl]['data'][feedUrl] = feedOpportunities
-
-                # ----------------------------------------------------------------------------------------------------
+        for catalogueUrl in opportunities['data'].keys():
 
+            for datasetUrl in opportunities['data'][catalogueUrl]['data'].keys():
                 opportunities['data'][catalogueUrl]['data'][datasetUrl]['metadata']['counts'] = sum([
                     val['metadata']['counts']
                     for val in opportunities['data'][catalogueUrl]['data'][datasetUrl]['data'].values()
                 ])
                 opportunities['data'][catalogueUrl]['data'][datasetUrl]['metadata']['timeLastUpdated'] = str(datetime.datetime.now())
 
-            # ----------------------------------------------------------------------------------------------------
-
             opportunities['data'][catalogueUrl]['metadata']['counts'] = sum([
                 val['metadata']['counts']
                 for val in opportunities['data'][catalogueUrl]['data'].values()
@@ -696,26 +1353,60 @@ def get_opportunities(
 
     # ----------------------------------------------------------------------------------------------------
 
-    if (    not exists(dirNameCache + fileNameOpportunities)
+    if (    not exists(dirNameCache + dirNameOpportunities + fileNameManifest)
         or  doRefresh
     ):
-        json.dump(opportunities, open(dirNameCache + fileNameOpportunities, 'w'))
+        write_cache(opportunities, dirNameOpportunities, depthOpportunities, fileNameOpportunities)
 
     # ----------------------------------------------------------------------------------------------------
 
-    if (not doPath):
-        output = opportunities
-    else:
-        output = copy.deepcopy(opportunities)
+    # Only the chunks for the requested catalogue, dataset and feed are read, if any of these are given, with the output
+    # then having only these branches and the counts to match:
+    output = read_cache_chunks(opportunities, dirNameOpportunities, depthOpportunities, [doCatalogueUrl, doDatasetUrl, doFeedUrl])
+
+    if (    doPath
+        or  doFields
+    ):
+        output = copy.deepcopy(output)
+        if (doFields):
+            fieldsCompiled = compile_fields(doFields)
+            if (not exists(dirNameCache + dirNameOpportunitiesRaw)):
+                print('ERROR: No raw opportunities stored, so refresh with doRaw to use doFields')
+                doFields = None
+            feedUrlsRawMissing = []
         for catalogueUrl in output['data'].keys():
             for datasetUrl in output['data'][catalogueUrl]['data'].keys():
                 for feedUrl in output['data'][catalogueUrl]['data'][datasetUrl]['data'].keys():
+
+                    # The source opportunities may be from an older refresh than the main cache, so fields are only
+                    # taken from them if they have the same modification as the opportunities in the main cache:
+                    if (doFields):
+                        try:
+                            with gzip.open(get_file_name_opportunities_raw(feedUrl), 'rt') as file:
+                                feedOpportunitiesRaw = json.load(file)
+                        except FileNotFoundError:
+                            feedUrlsRawMissing.append(feedUrl)
+                            feedOpportunitiesRaw = {}
+                        except:
+                            print('ERROR: Can\'t read raw opportunities for feed', catalogueUrl, '->', datasetUrl, '->', feedUrl)
+                            feedOpportunitiesRaw = {}
+
                     for opportunity in output['data'][catalogueUrl]['data'][datasetUrl]['data'][feedUrl]['data']:
-                        opportunity.update({
-                            'catalogueUrl': catalogueUrl,
-                            'datasetUrl': datasetUrl,
-                            'feedUrl': feedUrl,
-                        })
+                        if (    doFields
+                            and str(opportunity['id']) in feedOpportunitiesRaw.keys()
+                            and opportunity['modified'] == feedOpportunitiesRaw[str(opportunity['id'])]['modified']
+                        ):
+                            project_fields(feedOpportunitiesRaw[str(opportunity['id'])], fieldsCompiled, opportunity)
+                        if (doPath):
+                            opportunity.update({
+                                'catalogueUrl': catalogueUrl,
+                                'datasetUrl': datasetUrl,
+                                'feedUrl': feedUrl,
+                            })
+        if (    doFields
+            and len(feedUrlsRawMissing) > 0
+        ):
+            print('ERROR: No raw opportunities stored for', len(feedUrlsRawMissing), 'feeds, so refresh with doRaw to include them')
 
     if (doFlatten):
         return [
@@ -0,0 +1,183 @@
+import json
+import os
+import requests
+import shutil
+import tempfile
+import time
+import app as oa
+
+# ----------------------------------------------------------------------------------------------------
+
+# Measures the throughput of a refresh of large synthetic datasets and feeds, for an increasing number of processes in
+# the pool set by the doProcesses keyword. The requests are answered instantly from memory rather than over the network,
+# but otherwise everything runs just as in a real refresh, i.e. the pages are handed out by map_requests to the threads,
+# which pass each one in turn to the pool for parsing, and for the feeds this is done both without and with the full
+# source opportunities being sent back and stored via the doRaw keyword. The items counted are the records extracted,
+# i.e. the feeds found in the datasets and the opportunities found in the feeds, with deleted opportunities left out.
+# Run as:
+#
+#   $ python benchmark.py
+#
+# The synthetic datasets and feeds can be made larger or smaller via the following:
+
+numHosts = 16
+numDatasets = 100
+numFeeds = 64
+numPagesPerFeed = 4
+numOpportunitiesPerPage = 500
+
+# ----------------------------------------------------------------------------------------------------
+
+def make_dataset_page(datasetIdx):
+
+    jsonld = {
+        'name': 'Dataset ' + str(datasetIdx),
+        'publisher': {'name': 'Publisher ' + str(datasetIdx)},
+        'discussionUrl': 'https://github.com/example/dataset' + str(datasetIdx) + '/issues',
+        'license': 'https://creativecommons.org/licenses/by/4.0/',
+        'distribution': [
+            {'contentUrl': 'https://example.com/feeds/' + str(datasetIdx) + '/' + kind, 'name': kind}
+            for kind in ['SessionSeries', 'ScheduledSession', 'FacilityUse', 'Slot']
+        ],
+    }
+
+    return (
+            '<html><head><title>Dataset</title><script type="application/ld+json">' + json.dumps(jsonld) + '</script></head><body>'
+        +   ''.join(['<div class="row"><p>Lorem ipsum <a href="#' + str(rowIdx) + '">dolor</a> sit amet.</p></div>' for rowIdx in range(500)])
+        +   '</body></html>'
+    ).encode()
+
+# ----------------------------------------------------------------------------------------------------
+
+def make_feed_page(feedIdx, pageIdx):
+
+    return json.dumps({
+        'items': [
+            {
+                'state': 'deleted' if (opportunityIdx % 10 == 0) else 'updated',
+                'kind': 'ScheduledSession',
+                'id': str(pageIdx) + '-' + str(opportunityIdx),
+                'modified': pageIdx * numOpportunitiesPerPage + opportunityIdx,
+                'data': {
+                    'name': 'Session ' + str(opportunityIdx),
+                    'startDate': '2023-03-06T09:00:00Z',
+                    'activity': [{'id': 'https://openactive.io/activity-list#' + str(opportunityIdx), 'prefLabel': 'Activity'}],
+                    'location': {
+                        'name': 'Leisure Centre',
+                        'address': {'streetAddress': '1 High Street', 'postalCode': 'AB1 2CD'},
+                        'geo': {'latitude': 51.5, 'longitude': -0.1},
+                    },
+                    'description': 'Lorem ipsum dolor sit amet. ' * 10,
+                },
+            }
+            for opportunityIdx in range(numOpportunitiesPerPage)
+        ] if (pageIdx < numPagesPerFeed) else [],
+        'next': get_feed_url(feedIdx, min(pageIdx + 1, numPagesPerFeed)),
+    }).encode()
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_dataset_url(datasetIdx):
+
+    return 'https://host' + str(datasetIdx % numHosts) + '.example.com/datasets/' + str(datasetIdx)
+
+def get_feed_url(feedIdx, pageIdx):
+
+    return 'https://host' + str(feedIdx % numHosts) + '.example.com/feeds/' + str(feedIdx) + '?page=' + str(pageIdx)
+
+# ----------------------------------------------------------------------------------------------------
+
+pages = {}
+
+def get_page(url, timeout=None):
+
+    r = requests.Response()
+    r.status_code = 200
+    r.encoding = 'utf-8'
+    r._content = pages[url]
+
+    return r
+
+# ----------------------------------------------------------------------------------------------------
+
+def run_benchmark(function, argsList, doProcesses):
+
+    # Start each run from fresh hosts, so that the concurrency and spacing reached in one run don't carry over to the next:
+    oa.hosts.clear()
+
+    with oa.get_process_pool(doProcesses) as processPool:
+
+        # Start up the processes beforehand, so that only the refresh itself is timed:
+        if (processPool):
+            list(processPool.map(int, range(doProcesses)))
+
+        timeStart = time.perf_counter()
+        results = oa.map_requests(function, [args + (processPool,) for args in argsList])
+        timeTaken = time.perf_counter() - timeStart
+
+    return timeTaken, sum([result['metadata']['counts'] for result in results if (result is not None)])
+
+# ----------------------------------------------------------------------------------------------------
+
+if (__name__ == '__main__'):
+
+    for datasetIdx in range(numDatasets):
+        pages[get_dataset_url(datasetIdx)] = make_dataset_page(datasetIdx)
+    for feedIdx in range(numFeeds):
+        for pageIdx in range(numPagesPerFeed + 1):
+            pages[get_feed_url(feedIdx, pageIdx)] = make_feed_page(feedIdx, pageIdx)
+
+    oa.requests.get = get_page
+    oa.dirNameCache = tempfile.mkdtemp() + '/'
+    os.makedirs(oa.dirNameCache + oa.dirNameOpportunitiesRaw)
+
+    fieldsCompiled = oa.compile_fields(oa.opportunityFields)
+
+    benchmarks = [
+        (
+            'Datasets',
+            oa.get_dataset_feeds,
+            [(get_dataset_url(datasetIdx), 'catalogue', None) for datasetIdx in range(numDatasets)],
+        ),
+        (
+            'Feeds',
+            oa.get_feed_opportunities,
+            [(get_feed_url(feedIdx, 0), 'catalogue', 'dataset', None, fieldsCompiled, False) for feedIdx in range(numFeeds)],
+        ),
+        (
+            'Feeds with doRaw',
+            oa.get_feed_opportunities,
+            [(get_feed_url(feedIdx, 0), 'catalogue', 'dataset', None, fieldsCompiled, True) for feedIdx in range(numFeeds)],
+        ),
+    ]
+
+    numProcessesList = [None]
+    numProcesses = 1
+    while (numProcesses <= os.cpu_count()):
+        numProcessesList.append(numProcesses)
+        numProcesses *= 2
+    if (numProcessesList[-1] != os.cpu_count()):
+        numProcessesList.append(os.cpu_count())
+
+    for name,function,argsList in benchmarks:
+
+        print(name, '| Pages:', len(argsList) if (function == oa.get_dataset_feeds) else numFeeds * (numPagesPerFeed + 1))
+        print('Processes  Time (s)     Items     Items/s  Speedup')
+
+        timeTakenBase = None
+
+        for doProcesses in numProcessesList:
+            timeTaken, numItems = run_benchmark(function, argsList, doProcesses)
+            if (timeTakenBase is None):
+                timeTakenBase = timeTaken
+            print(
+                '{:>9}'.format(str(doProcesses) if doProcesses else 'None'),
+                '{:>9.2f}'.format(timeTaken),
+                '{:>9}'.format(numItems),
+                '{:>11.0f}'.format(numItems / timeTaken),
+                '{:>8.2f}'.format(timeTakenBase / timeTaken),
+            )
+
+        print()
+
+    shutil.rmtree(oa.dirNameCache)